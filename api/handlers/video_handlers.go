@@ -1,6 +1,7 @@
 package handlers
 
 import (
+	"bytes"
 	"crypto/md5"
 	"encoding/json"
 	"fmt"
@@ -197,26 +198,42 @@ func SearchByFaceHandler(c *gin.Context) {
 
 	matches := []FaceMatch{} // Initialize as empty slice, not nil
 
-	// Search through each video's faces
+	// Collect the faces of every processed video into one gallery
 	log.Printf("Searching through %d videos", len(allVideos))
+	galleryFaces := []string{}
+	faceVideoIDs := make(map[string]string)
 	for _, video := range allVideos {
 		log.Printf("Checking video %s: status=%s, faces=%d", video.ID, video.Status, len(video.FaceImages))
 		if video.Status == "completed" && len(video.FaceImages) > 0 {
-			// Compare search image with faces in this video
-			matchedFaces, err := compareFacesWithSearchImage(searchImagePath, video.FaceImages)
-			if err != nil {
-				log.Printf("Error comparing faces for video %s: %v", video.ID, err)
-				continue
+			for _, faceImage := range video.FaceImages {
+				galleryFaces = append(galleryFaces, faceImage)
+				faceVideoIDs[faceImage] = video.ID
 			}
+		}
+	}
+
+	// Compare the search image against the whole gallery in a single script run,
+	// so the search face is encoded once rather than once per video
+	matchedByVideo := make(map[string][]string)
+	if len(galleryFaces) > 0 {
+		matchedFaces, err := compareFacesWithSearchImage(searchImagePath, galleryFaces)
+		if err != nil {
+			log.Printf("Error comparing faces: %v", err)
+		}
+		for _, faceImage := range matchedFaces {
+			videoID := faceVideoIDs[faceImage]
+			matchedByVideo[videoID] = append(matchedByVideo[videoID], faceImage)
+		}
+	}
 
+	for _, video := range allVideos {
+		if matchedFaces := matchedByVideo[video.ID]; len(matchedFaces) > 0 {
 			log.Printf("Video %s: found %d matched faces", video.ID, len(matchedFaces))
-			if len(matchedFaces) > 0 {
-				matches = append(matches, FaceMatch{
-					Video:        video,
-					MatchedFaces: matchedFaces,
-					Similarity:   0.85, // Default similarity score
-				})
-			}
+			matches = append(matches, FaceMatch{
+				Video:        video,
+				MatchedFaces: matchedFaces,
+				Similarity:   0.85, // Default similarity score
+			})
 		}
 	}
 
@@ -268,10 +285,15 @@ func processVideoWithPython(videoPath string, videoID string) (*VideoUploadRespo
 	cmd := exec.Command("venv/bin/python3", pythonScriptPath, videoPath, "--video-id", videoID)
 	cmd.Dir = "." // Set working directory to api root
 
-	output, err := cmd.CombinedOutput()
+	// The script logs progress on stderr and writes only its JSON result to stdout
+	var stderr bytes.Buffer
+	cmd.Stderr = &stderr
+
+	output, err := cmd.Output()
 	if err != nil {
 		log.Printf("Python script error: %v", err)
 		log.Printf("Python output: %s", string(output))
+		log.Printf("Python log: %s", stderr.String())
 		return nil, fmt.Errorf("Python script execution failed: %v", err)
 	}
 
@@ -310,17 +332,21 @@ func compareFacesWithSearchImage(searchImagePath string, faceImages []string) ([
 		return nil, fmt.Errorf("Python face search script not found: %s", pythonScriptPath)
 	}
 
-	// Prepare face images list
-	faceImagesStr := strings.Join(faceImages, ",")
-
-	// Execute Python script for face comparison
-	cmd := exec.Command("venv/bin/python3", pythonScriptPath, searchImagePath, "--face-images", faceImagesStr)
+	// Execute Python script for face comparison. The face list goes on stdin,
+	// one name per line, since a whole gallery overflows the argument size limit.
+	cmd := exec.Command("venv/bin/python3", pythonScriptPath, searchImagePath, "--face-images-file", "-")
 	cmd.Dir = "." // Set working directory to api root
+	cmd.Stdin = strings.NewReader(strings.Join(faceImages, "\n"))
+
+	// The script logs progress on stderr and writes only its JSON result to stdout
+	var stderr bytes.Buffer
+	cmd.Stderr = &stderr
 
-	output, err := cmd.CombinedOutput()
+	output, err := cmd.Output()
 	if err != nil {
 		log.Printf("Face search Python script error: %v", err)
 		log.Printf("Face search Python output: %s", string(output))
+		log.Printf("Face search Python log: %s", stderr.String())
 		return nil, fmt.Errorf("face search script execution failed: %v", err)
 	}
 
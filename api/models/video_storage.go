@@ -234,6 +234,12 @@ func (vs *VideoStorage) ResetDatabase() error {
 				log.Printf("Warning: Could not remove face image %s: %v", facePath, err)
 			}
 		}
+
+		// Remove cached face encodings
+		encodingsPath := filepath.Join("../storage/faces", record.ID+"_encodings.npy")
+		if err := os.Remove(encodingsPath); err != nil && !os.IsNotExist(err) {
+			log.Printf("Warning: Could not remove face encodings %s: %v", encodingsPath, err)
+		}
 	}
 
 	// Clear all records
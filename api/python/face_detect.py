@@ -8,29 +8,213 @@ import sys
 import json
 import os
 import argparse
+import functools
+import itertools
+import math
+import multiprocessing
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
 import cv2
 import face_recognition
 import numpy as np
-from PIL import Image
 import warnings
 
+from face_index import FaceIndex
+
 # Suppress all warnings to ensure clean JSON output
 warnings.filterwarnings("ignore")
 
+# Progress goes to stderr so stdout carries only the JSON result
+log = functools.partial(print, file=sys.stderr)
+
+def emit_json(payload):
+    """Write the result to stdout as one JSON document"""
+    sys.stdout.buffer.write(json.dumps(payload, indent=2).encode() + b"\n")
+    sys.stdout.buffer.flush()
+
+# Batched CNN detection only pays off when dlib was built with CUDA;
+# otherwise we stay on the per-frame HOG detector.
+try:
+    import dlib
+    USE_CUDA = bool(dlib.DLIB_USE_CUDA) and dlib.cuda.get_num_devices() > 0
+except Exception:
+    USE_CUDA = False
+
+# Detection workers start from a fresh interpreter: when the pool starts,
+# this process is already decoding on several threads, and forking it can
+# deadlock the children or keep the parent from exiting
+POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+# Each spawned worker loads its own dlib models, so by default the pool is
+# capped here and never outnumbers the frames to sample
+MAX_DEFAULT_WORKERS = 8
+
+# Sampled frames decoded ahead of detection
+PREFETCH_FRAMES = 8
+
+# Threads encoding and writing face crops in the background
+WRITER_THREADS = 2
+
+def prefetch(iterable, size):
+    """Iterate on a background thread, keeping up to size items ready for the consumer"""
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    
+    def put(entry):
+        # Give up once the consumer has gone away instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+        
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close:
+                close()
+                
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            has_item, value = items.get()
+            if not has_item:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+# With a detect scale of 0, frames are shrunk so their shorter side is
+# about this many pixels. This keeps detection cost flat across resolutions,
+# but on HD/4K input faces smaller than roughly 40/480 of the shorter side
+# are no longer found; pass --detect-scale 1 to detect at full resolution.
+DETECT_SHORT_SIDE = 480
+
+def resolve_detect_scale(frame, detect_scale):
+    """Return detect_scale, or the automatic scale for this frame when it is 0"""
+    if detect_scale > 0:
+        return detect_scale
+    return min(1.0, DETECT_SHORT_SIDE / min(frame.shape[:2]))
+
+def write_jpeg(path, image):
+    """Encode a BGR image to JPEG in memory and write the file in one call"""
+    ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise ValueError(f"Could not encode {path.name}")
+    path.write_bytes(data)
+
+def detection_image(frame, detect_scale):
+    """Shrink a BGR frame to the detection scale and convert it to RGB"""
+    detect_scale = resolve_detect_scale(frame, detect_scale)
+    if detect_scale < 1:
+        frame = cv2.resize(frame, (0, 0), fx=detect_scale, fy=detect_scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+# By default, frames whose channels all vary less than this (black, white or
+# flat frames between scenes) skip detection. Dim footage can fall below it
+# while still showing a face, so --skip-blank-stddev 0 turns the check off.
+BLANK_FRAME_STDDEV = 8.0
+
+def is_blank(image, blank_stddev):
+    """True when every channel of a detection image varies less than blank_stddev"""
+    if blank_stddev <= 0:
+        return False
+    _, stddev = cv2.meanStdDev(image)
+    return stddev.max() < blank_stddev
+
+def upscale_locations(face_locations, frame, detect_scale):
+    """Map (top, right, bottom, left) boxes found on a downscaled frame back onto the full frame"""
+    detect_scale = resolve_detect_scale(frame, detect_scale)
+    if detect_scale >= 1:
+        return face_locations
+        
+    height, width = frame.shape[:2]
+    return [
+        (max(0, round(top / detect_scale)), min(width, round(right / detect_scale)),
+         min(height, round(bottom / detect_scale)), max(0, round(left / detect_scale)))
+        for top, right, bottom, left in face_locations
+    ]
+
+def encode_faces(frame, face_locations):
+    """Encode faces in a BGR frame, converting only the area around each face to RGB"""
+    height, width = frame.shape[:2]
+    face_encodings = []
+    for top, right, bottom, left in face_locations:
+        # Leave room for the landmark-aligned chip, which extends past the box
+        margin = max(bottom - top, right - left) // 2
+        y0, x0 = max(0, top - margin), max(0, left - margin)
+        y1, x1 = min(height, bottom + margin), min(width, right + margin)
+        region = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2RGB)
+        face_encodings.extend(
+            face_recognition.face_encodings(region, [(top - y0, right - x0, bottom - y0, left - x0)])
+        )
+    return face_encodings
+
+def detect_faces_in_frame(frame, detect_scale, blank_stddev):
+    """Find face locations and encodings in a single frame on the CPU"""
+    # Detect on the small frame, but encode and crop from the full-resolution one
+    image = detection_image(frame, detect_scale)
+    if is_blank(image, blank_stddev):
+        return [], []
+    face_locations = face_recognition.face_locations(image, model="hog")
+    face_locations = upscale_locations(face_locations, frame, detect_scale)
+    return face_locations, encode_faces(frame, face_locations)
+
+def init_detection_worker():
+    """Process pool initializer: keep OpenCV single-threaded inside each worker"""
+    # The pool already runs one frame per core, so OpenCV's own thread pool
+    # would only oversubscribe the CPU
+    cv2.setNumThreads(1)
+
+def detect_faces_in_shared_frame(name, shape, detect_scale, blank_stddev):
+    """Worker entry point: detect faces in a frame passed through shared memory"""
+    block = shared_memory.SharedMemory(name=name)
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+    try:
+        return detect_faces_in_frame(frame, detect_scale, blank_stddev)
+    finally:
+        del frame
+        block.close()
+
 class FaceProcessor:
-    def __init__(self, video_path, video_id=None, fps=1, threshold=0.6):
+    def __init__(self, video_path, video_id=None, fps=1, threshold=0.6, batch_size=128, workers=None, detect_scale=0,
+                 gpu_decode=False, blank_stddev=BLANK_FRAME_STDDEV):
         self.video_path = video_path
+        self.gpu_decode = gpu_decode
         self.fps = fps
         self.threshold = threshold
+        self.detect_scale = detect_scale
+        self.blank_stddev = blank_stddev
+        self.batch_size = batch_size
+        self.workers = workers or min(os.cpu_count() or 1, MAX_DEFAULT_WORKERS)
+        self.expected_samples = None
         self.known_faces = []
-        self.known_encodings = []
+        self.index = FaceIndex()
         self.face_count = 0
+        self.writer = None
+        self.pending_writes = []
         
         # Create faces directory if it doesn't exist
-        faces_dir = Path("../storage/faces")
-        faces_dir.mkdir(exist_ok=True)
+        self.faces_dir = Path("../storage/faces")
+        self.faces_dir.mkdir(exist_ok=True)
         
         # Use provided video ID or generate from filename
         if video_id:
@@ -39,92 +223,215 @@ class FaceProcessor:
             video_filename = Path(video_path).stem
             self.video_id = video_filename
         
+    def open_video(self, video_path):
+        """Open the video, decoding on the GPU (NVDEC/VAAPI via FFmpeg) when requested and available"""
+        if self.gpu_decode:
+            cap = cv2.VideoCapture(
+                video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+            )
+            if cap.isOpened() and cap.get(cv2.CAP_PROP_HW_ACCELERATION) != cv2.VIDEO_ACCELERATION_NONE:
+                log("Decoding video on the GPU")
+                return cap
+            log("Hardware video decoding unavailable, decoding on the CPU")
+            cap.release()
+        return cv2.VideoCapture(video_path)
+        
     def extract_frames(self, video_path):
-        """Extract frames from video at specified FPS"""
-        cap = cv2.VideoCapture(video_path)
+        """Yield (frame_number, bgr_frame) for frames sampled at the specified FPS"""
+        cap = self.open_video(video_path)
         if not cap.isOpened():
             raise ValueError("Could not open video file")
             
         # Get video properties
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         video_fps = cap.get(cv2.CAP_PROP_FPS)
-        duration = total_frames / video_fps
+        duration = total_frames / video_fps if video_fps > 0 else 0
         
-        print(f"Video info: {total_frames} frames, {video_fps:.2f} fps, {duration:.2f}s duration")
+        log(f"Video info: {total_frames} frames, {video_fps:.2f} fps, {duration:.2f}s duration")
         
-        frames = []
-        frame_interval = int(video_fps / self.fps)
+        # Sample frame round(i * video_fps / fps) for the i-th sample, so
+        # fractional rates such as 29.97 fps don't drift the way int() does
+        step = video_fps / self.fps if video_fps > 0 else 1
+        next_sample = 0
+        self.expected_samples = math.ceil(total_frames / step) if total_frames > 0 else None
         
         frame_count = 0
+        extracted = 0
+        try:
+            # grab() only advances the stream; retrieve() pays for the
+            # conversion to BGR, so skipped frames are never converted
+            while cap.grab():
+                if frame_count == next_sample:
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        break
+                    
+                    extracted += 1
+                    next_sample = max(frame_count + 1, round(extracted * step))
+                    yield extracted, frame
+                    
+                frame_count += 1
+        finally:
+            cap.release()
+            
+        log(f"Extracted {extracted} frames at {self.fps} fps")
+        
+    def detect_faces_in_batch(self, frames):
+        """Find face locations and encodings for a batch of frames on the GPU"""
+        # One CNN pass over the whole batch, leaving out blank frames
+        images = [detection_image(frame, self.detect_scale) for frame in frames]
+        active = [i for i, image in enumerate(images) if not is_blank(image, self.blank_stddev)]
+        batch_locations = [[] for _ in frames]
+        if active:
+            # Upsample once like the HOG path, so the CNN still finds small faces
+            found = face_recognition.batch_face_locations(
+                [images[i] for i in active], number_of_times_to_upsample=1, batch_size=self.batch_size
+            )
+            for i, face_locations in zip(active, found):
+                batch_locations[i] = face_locations
+        detections = []
+        for frame, face_locations in zip(frames, batch_locations):
+            face_locations = upscale_locations(face_locations, frame, self.detect_scale)
+            detections.append((face_locations, encode_faces(frame, face_locations)))
+        return detections
+        
+    def detect_batched(self, frames):
+        """Yield (frame_num, frame, detections) running the CNN detector over batches of frames"""
         while True:
-            ret, frame = cap.read()
-            if not ret:
+            batch = list(itertools.islice(frames, self.batch_size))
+            if not batch:
                 break
                 
-            if frame_count % frame_interval == 0:
-                # Convert BGR to RGB
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frames.append(rgb_frame)
+            detections = self.detect_faces_in_batch([frame for _, frame in batch])
+            for (frame_num, frame), detection in zip(batch, detections):
+                yield frame_num, frame, detection
                 
-            frame_count += 1
+    def detect_in_processes(self, frames):
+        """Yield (frame_num, frame, detections) in frame order, detecting on a process pool"""
+        # dlib holds the GIL while detecting, so frames go to worker processes
+        # through shared memory instead of being pickled. Capping the frames in
+        # flight keeps memory bounded by the pool size.
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return
             
-        cap.release()
-        print(f"Extracted {len(frames)} frames at {self.fps} fps")
-        return frames
+        # The number of frames to sample is known once decoding has started
+        workers = self.workers
+        if self.expected_samples:
+            workers = max(1, min(workers, self.expected_samples))
+        log(f"Detecting faces with HOG (CPU) model on {workers} processes")
         
-    def process_faces(self, frame, frame_num):
-        """Process faces in a single frame"""
-        # Find face locations
-        face_locations = face_recognition.face_locations(frame)
-        face_encodings = face_recognition.face_encodings(frame, face_locations)
+        max_in_flight = 2 * workers
+        pending = deque()
+        
+        # Every frame of a video has the same size, so blocks are recycled once
+        # their frame is done rather than created and unlinked per frame
+        free_blocks = []
         
-        print(f"Found {len(face_locations)} faces in frame {frame_num}")
+        def finish(item):
+            frame_num, frame, block, future = item
+            try:
+                return frame_num, frame, future.result()
+            finally:
+                free_blocks.append(block)
+                
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=POOL_CONTEXT, initializer=init_detection_worker
+            ) as executor:
+                for frame_num, frame in itertools.chain([first], frames):
+                    if free_blocks and free_blocks[-1].size >= frame.nbytes:
+                        block = free_blocks.pop()
+                    else:
+                        block = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+                    np.ndarray(frame.shape, dtype=np.uint8, buffer=block.buf)[:] = frame
+                    future = executor.submit(
+                        detect_faces_in_shared_frame, block.name, frame.shape, self.detect_scale, self.blank_stddev
+                    )
+                    pending.append((frame_num, frame, block, future))
+                    
+                    if len(pending) >= max_in_flight:
+                        yield finish(pending.popleft())
+                        
+                while pending:
+                    yield finish(pending.popleft())
+        finally:
+            # Release recycled blocks, and any left behind if processing stopped early
+            for block in free_blocks + [block for _, _, block, _ in pending]:
+                block.close()
+                block.unlink()
+        
+    def process_faces(self, frame, frame_num, face_locations, face_encodings):
+        """Process faces in a single frame"""
+        log(f"Found {len(face_locations)} faces in frame {frame_num}")
         
         new_faces = []
         
         for i, (face_location, face_encoding) in enumerate(zip(face_locations, face_encodings)):
             # Check if this face is similar to any known face
-            if len(self.known_encodings) > 0:
-                matches = face_recognition.compare_faces(self.known_encodings, face_encoding, tolerance=self.threshold)
-                if any(matches):
-                    print("Duplicate face detected (skipping)")
-                    continue
+            if self.index.find_match(face_encoding, self.threshold) is not None:
+                log("Duplicate face detected (skipping)")
+                continue
             
             # This is a new face
             self.face_count += 1
-            print(f"New face detected! Face #{self.face_count}")
+            log(f"New face detected! Face #{self.face_count}")
             
             # Save the face image with unique filename
             top, right, bottom, left = face_location
             face_image = frame[top:bottom, left:right]
             
-            # Convert to PIL Image and save with unique name
-            pil_image = Image.fromarray(face_image)
+            # Frames are BGR, so the crop is encoded by OpenCV without conversion.
+            # The write runs on the writer pool; the crop is copied so queued
+            # writes don't keep whole frames alive.
             face_filename = f"{self.video_id}_face_{self.face_count-1:03d}.jpg"
-            face_path = Path("../storage/faces") / face_filename
-            pil_image.save(face_path, "JPEG", quality=95)
+            face_path = self.faces_dir / face_filename
+            self.pending_writes.append(self.writer.submit(write_jpeg, face_path, face_image.copy()))
             
             # Add to known faces
             self.known_faces.append(face_filename)
-            self.known_encodings.append(face_encoding)
+            self.index.add(face_encoding)
             new_faces.append(face_filename)
             
         return new_faces
         
+    def save_encodings(self):
+        """Persist encodings of the saved faces so searches don't re-encode them"""
+        # Row i holds the encoding of {video_id}_face_{i:03d}.jpg
+        encodings_path = self.faces_dir / f"{self.video_id}_encodings.npy"
+        np.save(encodings_path, self.index.encodings())
+        
     def process_video(self):
         """Process the entire video"""
         start_time = time.time()
         
-        # Extract frames
-        frames = self.extract_frames(self.video_path)
+        # Frames are streamed, so only the frames being detected are held in memory.
+        # OpenCV releases the GIL while decoding, so the next frames are decoded
+        # on a separate thread while the current ones are being detected.
+        frames = prefetch(self.extract_frames(self.video_path), PREFETCH_FRAMES)
+        
+        if USE_CUDA:
+            log("Detecting faces with CNN (CUDA) model")
+            detections = self.detect_batched(frames)
+        else:
+            detections = self.detect_in_processes(frames)
         
-        # Process each frame
-        for i, frame in enumerate(frames):
-            print(f"Processing frame {i+1}/{len(frames)}")
-            self.process_faces(frame, i+1)
+        # Deduplicate in frame order so face numbering is deterministic.
+        # Leaving the block waits for every face image to be written.
+        with ThreadPoolExecutor(max_workers=WRITER_THREADS) as self.writer:
+            for frame_num, frame, (face_locations, face_encodings) in detections:
+                log(f"Processing frame {frame_num}")
+                self.process_faces(frame, frame_num, face_locations, face_encodings)
+                
+        # Surface errors raised while writing
+        for write in self.pending_writes:
+            write.result()
+            
+        self.save_encodings()
             
         processing_time = time.time() - start_time
-        print(f"Processing complete! Found {self.face_count} unique faces in {processing_time:.2f} seconds")
+        log(f"Processing complete! Found {self.face_count} unique faces in {processing_time:.2f} seconds")
         
         return {
             "unique_faces_count": self.face_count,
@@ -139,20 +446,30 @@ def main():
     parser.add_argument("--video-id", help="Unique video ID for face naming")
     parser.add_argument("--fps", type=int, default=1, help="Frames per second to extract (default: 1)")
     parser.add_argument("--threshold", type=float, default=0.6, help="Face similarity threshold (default: 0.6)")
+    parser.add_argument("--batch-size", type=int, default=128, help="Frames per CNN detection batch on GPU (default: 128)")
+    parser.add_argument("--workers", type=int, help=f"Detection processes on CPU (default: number of CPUs, up to {MAX_DEFAULT_WORKERS})")
+    parser.add_argument("--detect-scale", type=float, default=0,
+                        help=f"Frame scale used for face detection (default: 0, shorter side scaled to {DETECT_SHORT_SIDE}px)")
+    parser.add_argument("--gpu-decode", action="store_true", help="Decode the video on the GPU when available")
+    parser.add_argument("--skip-blank-stddev", type=float, default=BLANK_FRAME_STDDEV,
+                        help=f"Skip detection on frames with less contrast than this (default: {BLANK_FRAME_STDDEV}, 0 to disable)")
     
     args = parser.parse_args()
     
     if not os.path.exists(args.video_path):
-        print(json.dumps({"error": "Video file not found"}))
+        emit_json({"error": "Video file not found"})
         sys.exit(1)
         
     try:
-        processor = FaceProcessor(args.video_path, args.video_id, args.fps, args.threshold)
+        processor = FaceProcessor(
+            args.video_path, args.video_id, args.fps, args.threshold,
+            batch_size=args.batch_size, workers=args.workers,
+            detect_scale=args.detect_scale, gpu_decode=args.gpu_decode,
+            blank_stddev=args.skip_blank_stddev
+        )
         result = processor.process_video()
         
-        sys.stdout.flush()  # Clear any buffered output
-        print(json.dumps(result, indent=2))
-        sys.stdout.flush()  # Ensure output is sent
+        emit_json(result)
         
     except Exception as e:
         error_response = {
@@ -162,9 +479,7 @@ def main():
             "message": "Video processing failed",
             "processing_time_seconds": 0
         }
-        sys.stdout.flush()  # Clear any buffered output
-        print(json.dumps(error_response, indent=2))
-        sys.stdout.flush()  # Ensure output is sent
+        emit_json(error_response)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Face Encoding Index
+Nearest-neighbour lookup over 128-d face encodings, backed by FAISS when it
+is installed, then a Numba kernel, then a single BLAS matrix-vector product
+"""
+
+import itertools
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# The Numba kernels are an optional fallback for installs without FAISS. They
+# compile on first use (cache=True keeps the result on disk), so importing
+# this module stays cheap for scripts that never run a lookup.
+best_match = None
+if faiss is None:
+    try:
+        from kernels import PARALLEL_MIN_ROWS, best_match, best_match_serial
+    except ImportError:
+        pass
+
+ENCODING_DIM = 128
+
+# FAISS scans 8-bit codes and the candidates it returns are re-ranked with
+# the float encodings. dlib encodings sit well inside [-1, 1], so a step of
+# 1/127 bounds the L2 error of a quantised encoding by QUANT_ERROR.
+QUANT_SCALE = 127.0
+QUANT_ERROR = np.sqrt(ENCODING_DIM) * 0.5 / QUANT_SCALE
+
+# Encodings are also bucketed by the signs of their projections onto random
+# hyperplanes. A match lookup first checks buckets within LSH_PROBE_RADIUS
+# bits, then falls back to a full search, so results stay exact.
+LSH_BITS = 16
+LSH_PROBE_RADIUS = 2
+LSH_SEED = 0
+
+def probe_masks(bits, radius):
+    """XOR masks selecting every bucket id within radius bits of a given one"""
+    masks = [0]
+    for flips in range(1, radius + 1):
+        masks.extend(sum(1 << bit for bit in combo) for combo in itertools.combinations(range(bits), flips))
+    return masks
+
+LSH_PROBE_MASKS = probe_masks(LSH_BITS, LSH_PROBE_RADIUS)
+
+# Encodings live in one preallocated block that doubles when full
+INITIAL_CAPACITY = 64
+ALIGNMENT = 64
+
+def as_matrix(encodings):
+    """Convert one encoding or a list of encodings to a contiguous (N, 128) float32 matrix"""
+    return np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM))
+
+def aligned_matrix(rows):
+    """Allocate an uninitialised (rows, 128) float32 matrix starting on a 64-byte boundary"""
+    nbytes = rows * ENCODING_DIM * 4
+    raw = np.empty(nbytes + ALIGNMENT, dtype=np.uint8)
+    offset = -raw.ctypes.data % ALIGNMENT
+    return raw[offset:offset + nbytes].view(np.float32).reshape(rows, ENCODING_DIM)
+
+def quantize(encodings):
+    """Map encodings onto the 0-255 grid stored by an 8-bit direct scalar quantizer"""
+    codes = np.clip(np.round(as_matrix(encodings) * QUANT_SCALE), -127, 127) + 128
+    return np.ascontiguousarray(codes, dtype=np.float32)
+
+class FaceIndex:
+    def __init__(self):
+        self.index = None
+        if faiss:
+            self.index = faiss.IndexScalarQuantizer(
+                ENCODING_DIM, faiss.ScalarQuantizer.QT_8bit_direct, faiss.METRIC_L2
+            )
+        self._buffer = aligned_matrix(INITIAL_CAPACITY)
+        self._sqnorm_buffer = np.empty(INITIAL_CAPACITY, dtype=np.float32)
+        self._count = 0
+        self._hyperplanes = np.random.default_rng(LSH_SEED).standard_normal((LSH_BITS, ENCODING_DIM)).astype(np.float32)
+        self._bit_weights = 1 << np.arange(LSH_BITS)
+        self._buckets = {}
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def _matrix(self):
+        return self._buffer[:self._count]
+
+    @property
+    def _sqnorms(self):
+        return self._sqnorm_buffer[:self._count]
+
+    def _reserve(self, rows):
+        """Grow the buffers, doubling capacity, until rows more encodings fit"""
+        capacity = len(self._buffer)
+        if self._count + rows <= capacity:
+            return
+        while self._count + rows > capacity:
+            capacity *= 2
+
+        buffer = aligned_matrix(capacity)
+        buffer[:self._count] = self._matrix
+        sqnorm_buffer = np.empty(capacity, dtype=np.float32)
+        sqnorm_buffer[:self._count] = self._sqnorms
+        self._buffer, self._sqnorm_buffer = buffer, sqnorm_buffer
+
+    def encodings(self):
+        """Return all stored encodings as an (N, 128) float32 matrix"""
+        return self._matrix
+
+    def add(self, encodings):
+        """Add one encoding or an (N, 128) matrix of encodings"""
+        encodings = as_matrix(encodings)
+        self._reserve(len(encodings))
+        end = self._count + len(encodings)
+        self._buffer[self._count:end] = encodings
+        self._sqnorm_buffer[self._count:end] = np.einsum("ij,ij->i", encodings, encodings)
+        for position, bucket in enumerate(self.bucket_ids(encodings), start=self._count):
+            self._buckets.setdefault(bucket, []).append(position)
+        self._count = end
+        if self.index is not None:
+            self.index.add(quantize(encodings))
+
+    def bucket_ids(self, encodings):
+        """LSH bucket id of each encoding: one bit per hyperplane side"""
+        signs = (as_matrix(encodings) @ self._hyperplanes.T) > 0
+        return [int(bucket) for bucket in signs @ self._bit_weights]
+
+    def squared_distances(self, encoding):
+        """Squared L2 distance from encoding to every stored encoding"""
+        # ||m - q||^2 = ||m||^2 + ||q||^2 - 2 m.q, where m.q is a single SGEMV call
+        query = as_matrix(encoding)[0]
+        distances = self._sqnorms + query @ query - 2 * (self._matrix @ query)
+        return np.maximum(distances, 0)
+
+    def rerank(self, encoding, positions):
+        """Exact squared L2 distance from encoding to the stored encodings at positions"""
+        differences = self._matrix[positions] - as_matrix(encoding)[0]
+        return np.einsum("ij,ij->i", differences, differences)
+
+    def nearest(self, encoding):
+        """Return (distance, position) of the closest stored encoding, or (inf, -1) when empty"""
+        # An exact scan: quantised FAISS hits can miss the true nearest encoding
+        if len(self) == 0:
+            return float("inf"), -1
+
+        if best_match is not None:
+            kernel = best_match if len(self) >= PARALLEL_MIN_ROWS else best_match_serial
+            position, distance = kernel(self._matrix, as_matrix(encoding)[0])
+            return float(np.sqrt(distance)), int(position)
+
+        distances = self.squared_distances(encoding)
+        position = int(distances.argmin())
+        return float(np.sqrt(distances[position])), position
+
+    def find_match(self, encoding, tolerance):
+        """Return (distance, position) of a stored encoding within tolerance, or None if there is none"""
+        # Squaring would turn a negative tolerance into a positive radius
+        if tolerance < 0:
+            return None
+            
+        # Repeated faces usually land in a nearby bucket, so most duplicates are
+        # confirmed without touching the rest of the index
+        bucket = self.bucket_ids(encoding)[0]
+        candidates = [
+            position
+            for mask in LSH_PROBE_MASKS
+            for position in self._buckets.get(bucket ^ mask, ())
+        ]
+        if candidates:
+            distances = self.rerank(encoding, candidates)
+            best = int(distances.argmin())
+            if distances[best] <= tolerance ** 2:
+                return float(np.sqrt(distances[best])), candidates[best]
+
+        if self.index is not None:
+            # The 8-bit codes only bound distances, so filter a widened range
+            # search exactly
+            matches = self.within(encoding, tolerance)
+            if not matches:
+                return None
+            position, distance = min(matches, key=lambda match: match[1])
+            return distance, position
+            
+        distance, position = self.nearest(encoding)
+        if distance <= tolerance:
+            return distance, position
+        return None
+
+    def within(self, encoding, tolerance):
+        """Return (position, distance) for every stored encoding within tolerance (L2), in insertion order"""
+        if len(self) == 0 or tolerance < 0:
+            return []
+
+        if self.index is not None:
+            # Widen the radius by the quantisation error of both sides, then filter exactly
+            radius = ((tolerance + 2 * QUANT_ERROR) * QUANT_SCALE) ** 2
+            limits, _, candidates = self.index.range_search(quantize(encoding), radius)
+            candidates = np.sort(candidates[limits[0]:limits[1]])
+            distances = self.rerank(encoding, candidates)
+            return [
+                (int(p), float(np.sqrt(d)))
+                for p, d in zip(candidates, distances) if d <= tolerance ** 2
+            ]
+
+        distances = self.squared_distances(encoding)
+        positions = np.flatnonzero(distances <= tolerance ** 2)
+        return [(int(p), float(np.sqrt(distances[p]))) for p in positions]
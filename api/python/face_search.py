@@ -2,6 +2,10 @@ import sys
 import json
 import os
 import argparse
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import cv2
 import face_recognition
 import numpy as np
@@ -11,11 +15,48 @@ import warnings
 # Suppress all warnings to ensure clean JSON output
 warnings.filterwarnings("ignore")
 
-def load_and_encode_image(image_path):
-    """Load and encode a face image"""
+# Progress goes to stderr so stdout carries only the JSON result
+log = functools.partial(print, file=sys.stderr)
+
+def emit_json(payload):
+    """Write the result to stdout as one JSON document"""
+    sys.stdout.buffer.write(json.dumps(payload, indent=2).encode() + b"\n")
+    sys.stdout.buffer.flush()
+
+# Threads decoding face images that have no cached encoding
+DECODE_THREADS = 4
+
+# Large photos are decoded at a reduced size, keeping at least this long a side
+MAX_DECODE_SIDE = 1600
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def load_image(image_path):
+    """Decode an image as RGB, letting libjpeg-turbo downscale large photos while decoding"""
+    # PIL only parses the header here, which is enough to pick the reduction
+    with Image.open(image_path) as header:
+        longest_side = max(header.size)
+        
+    reduction = 1
+    while reduction < 8 and longest_side / (reduction * 2) >= MAX_DECODE_SIDE:
+        reduction *= 2
+        
+    image = cv2.imread(image_path, REDUCED_READ_FLAGS[reduction])
+    if image is None:
+        # Formats OpenCV can't decode (GIF before 4.11) are loaded through PIL
+        return face_recognition.load_image_file(image_path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def load_and_encode_image(image_path, image=None):
+    """Load and encode a face image, unless it was already decoded"""
     try:
         # Load image
-        image = face_recognition.load_image_file(image_path)
+        if image is None:
+            image = load_image(image_path)
         
         # Find face locations
         face_locations = face_recognition.face_locations(image)
@@ -33,12 +74,52 @@ def load_and_encode_image(image_path):
         return face_encodings[0]
         
     except Exception as e:
-        print(f"Error loading image {image_path}: {str(e)}")
+        log(f"Error loading image {image_path}: {str(e)}")
         return None
 
+def load_cached_encoding(face_image, encoding_cache):
+    """Look up the encoding face_detect saved for a face image, or None if not cached"""
+    # Face images are named {video_id}_face_{index:03d}.jpg
+    video_id, _, face_index = Path(face_image).stem.rpartition("_face_")
+    if not video_id or not face_index.isdigit():
+        return None
+    
+    if video_id not in encoding_cache:
+        encodings_path = f"../storage/faces/{video_id}_encodings.npy"
+        encoding_cache[video_id] = np.load(encodings_path, mmap_mode="r") if os.path.exists(encodings_path) else None
+    
+    encodings = encoding_cache[video_id]
+    if encodings is None or int(face_index) >= len(encodings):
+        return None
+    return encodings[int(face_index)]
+
+def read_face_list(path):
+    """Read face image names, one per line, from a file or from stdin when path is '-'"""
+    if path == "-":
+        return sys.stdin.read().splitlines()
+    with open(path) as face_list:
+        return face_list.read().splitlines()
+
+def faces_within(search_encoding, stored_encodings, tolerance):
+    """Return (position, distance) for every stored encoding within tolerance (L2) of the search encoding"""
+    # A single query doesn't repay building an index, so scan the encodings once
+    if not stored_encodings or tolerance < 0:
+        return []
+        
+    known = np.asarray(stored_encodings, dtype=np.float32)
+    query = np.asarray(search_encoding, dtype=np.float32)
+    
+    # ||k - q||^2 = ||k||^2 + ||q||^2 - 2 k.q, where k.q is a single SGEMV call
+    distances = np.einsum("ij,ij->i", known, known) + query @ query - 2 * (known @ query)
+    positions = np.flatnonzero(distances <= tolerance ** 2)
+    return [(int(p), float(np.sqrt(max(distances[p], 0)))) for p in positions]
+
 def compare_faces(search_encoding, face_images, similarity_threshold=0.5):
     """Compare search face with stored face images"""
-    matched_faces = []
+    stored_faces = []
+    stored_encodings = []
+    encoding_cache = {}
+    uncached_faces = []
     
     for face_image in face_images:
         try:
@@ -46,63 +127,92 @@ def compare_faces(search_encoding, face_images, similarity_threshold=0.5):
             clean_face_image = face_image.replace('faces/', '')
             face_path = f"../storage/faces/{clean_face_image}"
             
-            print(f"Checking face image: {face_path}")
+            log(f"Checking face image: {face_path}")
             
             if not os.path.exists(face_path):
-                print(f"Face image not found: {face_path}")
+                log(f"Face image not found: {face_path}")
                 continue
             
-            # Load and encode the stored face
-            stored_encoding = load_and_encode_image(face_path)
-            
+            # Use the encoding saved at detection time, re-encoding only older faces
+            stored_encoding = load_cached_encoding(clean_face_image, encoding_cache)
             if stored_encoding is None:
+                uncached_faces.append((face_image, face_path))
                 continue
             
-            # Compare faces
-            distance = face_recognition.face_distance([stored_encoding], search_encoding)[0]
-            similarity = 1 - distance
-            
-            # If similarity is above threshold, consider it a match
-            if similarity >= similarity_threshold:
-                matched_faces.append(face_image)  # Keep original path for response
-                print(f"Match found: {face_image} (similarity: {similarity:.3f})")
+            stored_faces.append(face_image)  # Keep original path for response
+            stored_encodings.append(stored_encoding)
             
         except Exception as e:
-            print(f"Error comparing with {face_image}: {str(e)}")
+            log(f"Error comparing with {face_image}: {str(e)}")
             continue
     
+    def encode_decoded(face_image, face_path, future):
+        try:
+            stored_encoding = load_and_encode_image(face_path, future.result())
+        except Exception as e:
+            log(f"Error loading image {face_path}: {str(e)}")
+            return
+        
+        if stored_encoding is not None:
+            stored_faces.append(face_image)  # Keep original path for response
+            stored_encodings.append(stored_encoding)
+    
+    # Decode uncached faces on a thread pool so JPEG decoding overlaps encoding.
+    # Capping the decodes in flight keeps memory flat however large the gallery is.
+    max_in_flight = 2 * DECODE_THREADS
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=DECODE_THREADS) as pool:
+        for face_image, face_path in uncached_faces:
+            pending.append((face_image, face_path, pool.submit(load_image, face_path)))
+            if len(pending) >= max_in_flight:
+                encode_decoded(*pending.popleft())
+                
+        while pending:
+            encode_decoded(*pending.popleft())
+    
+    # A similarity of (1 - distance) above threshold is a match
+    matched_faces = []
+    for position, distance in faces_within(search_encoding, stored_encodings, 1 - similarity_threshold):
+        matched_faces.append(stored_faces[position])
+        log(f"Match found: {stored_faces[position]} (similarity: {1 - distance:.3f})")
+    
     return matched_faces
 
 def main():
     parser = argparse.ArgumentParser(description="Search for faces in stored images")
     parser.add_argument("search_image", help="Path to the search image")
     parser.add_argument("--face-images", help="Comma-separated list of face images to compare")
+    parser.add_argument("--face-images-file", help="File listing face images to compare, one per line ('-' for stdin)")
     parser.add_argument("--threshold", type=float, default=0.5, help="Similarity threshold (default: 0.5)")
     
     args = parser.parse_args()
     
     if not os.path.exists(args.search_image):
-        print(json.dumps({"error": "Search image not found"}))
+        emit_json({"error": "Search image not found"})
         sys.exit(1)
     
     try:
         # Load and encode the search image
-        print(f"Loading search image: {args.search_image}")
+        log(f"Loading search image: {args.search_image}")
         search_encoding = load_and_encode_image(args.search_image)
         
         if search_encoding is None:
-            print(json.dumps({"error": "No face found in search image"}))
+            emit_json({"error": "No face found in search image"})
             sys.exit(1)
         
         # Parse face images list
-        if not args.face_images:
-            print(json.dumps({"error": "No face images provided"}))
+        if args.face_images_file:
+            face_images = read_face_list(args.face_images_file)
+        elif args.face_images:
+            face_images = args.face_images.split(",")
+        else:
+            emit_json({"error": "No face images provided"})
             sys.exit(1)
         
-        face_images = [img.strip() for img in args.face_images.split(",") if img.strip()]
+        face_images = [img.strip() for img in face_images if img.strip()]
         
         if not face_images:
-            print(json.dumps({"error": "No valid face images provided"}))
+            emit_json({"error": "No valid face images provided"})
             sys.exit(1)
         
         # Compare faces
@@ -115,9 +225,7 @@ def main():
             "matches_found": len(matched_faces)
         }
         
-        sys.stdout.flush()  # Clear any buffered output
-        print(json.dumps(result, indent=2))
-        sys.stdout.flush()  # Ensure output is sent
+        emit_json(result)
         
     except Exception as e:
         error_response = {
@@ -126,9 +234,7 @@ def main():
             "total_faces_checked": 0,
             "matches_found": 0
         }
-        sys.stdout.flush()  # Clear any buffered output
-        print(json.dumps(error_response, indent=2))
-        sys.stdout.flush()  # Ensure output is sent
+        emit_json(error_response)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Numeric Kernels
+Numba-compiled distance kernels for matching face encodings
+"""
+
+import numpy as np
+from numba import njit, prange
+
+# Below this many rows, starting the thread pool costs more than the scan
+PARALLEL_MIN_ROWS = 4096
+
+@njit(fastmath=True, cache=True)
+def best_match_serial(known, query):
+    """Single-threaded best_match for small indexes, tracking the minimum as it scans"""
+    count, dim = known.shape
+    position = 0
+    best = np.float32(np.inf)
+    for i in range(count):
+        total = np.float32(0.0)
+        for k in range(dim):
+            diff = known[i, k] - query[k]
+            total += diff * diff
+        if total < best:
+            best = total
+            position = i
+    return position, best
+
+@njit(parallel=True, fastmath=True, cache=True)
+def best_match(known, query):
+    """Return (position, squared distance) of the row of known closest to query"""
+    count, dim = known.shape
+    distances = np.empty(count, dtype=np.float32)
+    
+    # The inner loop is vectorised by LLVM; rows are spread across threads
+    for i in prange(count):
+        total = np.float32(0.0)
+        for k in range(dim):
+            diff = known[i, k] - query[k]
+            total += diff * diff
+        distances[i] = total
+        
+    position = 0
+    for i in range(1, count):
+        if distances[i] < distances[position]:
+            position = i
+    return position, distances[position]
@@ -28,22 +28,24 @@ def cleanup_old_files(directory: str, max_age_hours: int = 24):
     removed_count = 0
     total_size = 0
     
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        
-        if os.path.isfile(file_path):
-            file_age = current_time - os.path.getmtime(file_path)
+    # scandir entries carry the file type, so only one stat per file is needed
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Symlinks are followed, as os.path.isfile did
+            if not entry.is_file():
+                continue
+                
+            stat = entry.stat()
+            file_age = current_time - stat.st_mtime
             
             if file_age > max_age_seconds:
-                file_size = os.path.getsize(file_path)
-                total_size += file_size
-                
                 try:
-                    os.remove(file_path)
+                    os.remove(entry.path)
                     removed_count += 1
-                    print(f"Removed: {file_path}")
+                    total_size += stat.st_size
+                    print(f"Removed: {entry.path}")
                 except OSError as e:
-                    print(f"Error removing {file_path}: {e}")
+                    print(f"Error removing {entry.path}: {e}")
     
     if removed_count > 0:
         print(f"Cleaned {directory}: {removed_count} files removed, {total_size / (1024*1024):.2f} MB freed")